@@ -1,6 +1,6 @@
-import os
+import pathlib
 
-bare_dir = os.path.dirname(os.path.realpath(__file__))
+bare_dir = pathlib.Path(__file__).resolve().parent
 
 
 def hashOpts(opts):
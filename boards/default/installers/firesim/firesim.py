@@ -30,8 +30,7 @@ def install(targetCfg, opts):
         raise NotImplementedError("nodisk builds not currently supported by the install command")
 
     fsTargetDir = fsWork / targetCfg['name']
-    if not fsTargetDir.exists():
-        fsTargetDir.mkdir()
+    fsTargetDir.mkdir(exist_ok=True)
 
     # Path to dummy rootfs to use if no image specified (firesim requires a
     # rootfs, even if it's not used)
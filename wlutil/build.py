@@ -40,7 +40,7 @@ def buildBusybox():
         return doit.exceptions.TaskFailed(e)
 
     shutil.copy(wlutil.getOpt('wlutil-dir') / 'busybox-config', wlutil.getOpt('busybox-dir') / '.config')
-    wlutil.run(['make', '-j' + str(wlutil.getOpt('jlevel'))], cwd=wlutil.getOpt('busybox-dir'))
+    wlutil.run(['make', wlutil.getOpt('jlevel-arg')], cwd=wlutil.getOpt('busybox-dir'))
     shutil.copy(wlutil.getOpt('busybox-dir') / 'busybox', wlutil.getOpt('initramfs-dir') / 'disk' / 'bin/')
     return True
 
@@ -376,12 +376,12 @@ def makeInitramfs(srcs, cpioDir, includeDevNodes=False):
     if includeDevNodes:
         cpios.append(wlutil.getOpt('initramfs-dir') / 'devNodes.cpio')
 
-    # Generate final cpio
+    # Generate final cpio (1MiB buffer to amortize read/write syscalls)
     finalPath = cpioDir / 'initramfs.cpio'
     with open(finalPath, 'wb') as finalF:
         for cpio in cpios:
             with open(cpio, 'rb') as srcF:
-                shutil.copyfileobj(srcF, finalF)
+                shutil.copyfileobj(srcF, finalF, length=1 << 20)
 
     return finalPath
 
@@ -405,11 +405,11 @@ def generateKConfig(kfrags, linuxSrc):
 
 
 def makeInitramfsKfrag(src, dst):
-    with open(dst, 'w') as f:
-        f.write("CONFIG_BLK_DEV_INITRD=y\n")
-        f.write('CONFIG_INITRAMFS_COMPRESSION=".lzo"\n')
-        f.write('CONFIG_INITRAMFS_COMPRESSION_LZO=y\n')
-        f.write('CONFIG_INITRAMFS_SOURCE="' + str(src) + '"\n')
+    dst.write_text(
+            "CONFIG_BLK_DEV_INITRD=y\n"
+            'CONFIG_INITRAMFS_COMPRESSION=".lzo"\n'
+            'CONFIG_INITRAMFS_COMPRESSION_LZO=y\n'
+            'CONFIG_INITRAMFS_SOURCE="' + str(src) + '"\n')
 
 
 def makeModules(cfg):
@@ -426,7 +426,7 @@ def makeModules(cfg):
     if ('modules' in linCfg) and (len(linCfg['modules']) != 0):
         # Prepare the linux source for building external modules
         wlutil.run(["make"] + wlutil.getOpt('linux-make-args') +
-                   ["modules_prepare", '-j' + str(wlutil.getOpt('jlevel'))],
+                   ["modules_prepare", wlutil.getOpt('jlevel-arg')],
                    cwd=linCfg['source'])
 
         makeCmd = "make LINUXSRC=" + str(linCfg['source'])
@@ -471,7 +471,7 @@ def makeBBL(config, nodisk=False):
         configureArgs += config['firmware']['bbl-build-args']
 
     wlutil.run(['../configure'] + configureArgs, cwd=bblBuild)
-    wlutil.run(['make', '-j' + str(wlutil.getOpt('jlevel'))], cwd=bblBuild)
+    wlutil.run(['make', wlutil.getOpt('jlevel-arg')], cwd=bblBuild)
 
     return bblBuild / 'bbl'
 
@@ -537,7 +537,7 @@ def makeBin(config, nodisk=False):
 
             makeInitramfsKfrag(initramfsPath, cpioDir / "initramfs.kfrag")
             generateKConfig(config['linux']['config'] + [cpioDir / "initramfs.kfrag"], config['linux']['source'])
-            wlutil.run(['make'] + wlutil.getOpt('linux-make-args') + ['vmlinux', 'Image', '-j' + str(wlutil.getOpt('jlevel'))], cwd=config['linux']['source'])
+            wlutil.run(['make'] + wlutil.getOpt('linux-make-args') + ['vmlinux', 'Image', wlutil.getOpt('jlevel-arg')], cwd=config['linux']['source'])
 
         if 'use-bbl' in config.get('firmware', {}) and config['firmware']['use-bbl']:
             fw = makeBBL(config, nodisk)
@@ -566,13 +566,19 @@ def makeImage(config):
     if config['img-sz'] != 0:
         wlutil.resizeFS(config['img'], config['img-sz'])
 
+    # The overlay and file list are copied in together so the image only has
+    # to be mounted once (mounting dominates when using guestmount)
+    flist = []
     if 'overlay' in config:
         log.info("Applying Overlay: " + str(config['overlay']))
-        wlutil.applyOverlay(config['img'], config['overlay'])
+        flist += wlutil.overlaySpecs(config['overlay'])
 
     if 'files' in config:
         log.info("Applying file list: " + str(config['files']))
-        wlutil.copyImgFiles(config['img'], config['files'], 'in')
+        flist += config['files']
+
+    if len(flist) != 0:
+        wlutil.copyImgFiles(config['img'], flist, 'in')
 
     if 'guest-init' in config:
         log.info("Applying init script: " + str(config['guest-init'].path))
@@ -3,11 +3,12 @@ import subprocess as sp
 import logging
 import time
 import random
-import string
+import secrets
 import sys
 import collections
-import errno
 import pathlib
+import shutil
+import stat
 import git
 import json
 import hashlib
@@ -21,6 +22,10 @@ import importlib.util
 import psutil
 import signal
 
+# logging.getLogger() always returns the same root logger object; cache the
+# lookup once instead of repeating it in every helper
+log = logging.getLogger()
+
 cleanUpFunctions = []
 
 
@@ -43,6 +48,13 @@ signal.signal(signal.SIGINT, sigIntHandler)
 # Useful for defining lists of files (e.g. 'files' part of config)
 FileSpec = collections.namedtuple('FileSpec', ['src', 'dst'])
 
+# Frozen at import: marshal never chdir()s so the working directory is
+# stable, and the CPU count is only consulted once per run. The affinity mask
+# counts CPUs this process may actually run on, so a taskset/cgroup-pinned
+# marshal won't oversubscribe the way os.cpu_count() would.
+_nCpus = len(os.sched_getaffinity(0))
+_cwd = os.getcwd()
+
 # Global configuration (marshalCtx set by initialize())
 ctx = None
 
@@ -215,7 +227,10 @@ derivedOpts = [
         'buildroot-dir',
 
         # Arguments to pass when calling make on linux
-        'linux-make-args'
+        'linux-make-args',
+
+        # Make parallelism flag ('-jN') derived from jlevel
+        'jlevel-arg'
         ]
 
 
@@ -338,7 +353,9 @@ class marshalCtx(collections.abc.MutableMapping):
         self['run-name'] = ""
         self['rootfs-margin'] = humanfriendly.parse_size(str(self['rootfs-margin']))
 
-        self['driver-dirs'] = list(self['board-dir'].glob('drivers/*'))
+        # Globs are evaluated once here and sorted so option derivation (and
+        # anything keyed off it, like doit's uptodate checks) is deterministic
+        self['driver-dirs'] = sorted(self['board-dir'].glob('drivers/*'))
         self['bbl-dir'] = self['board-dir'] / 'firmware' / 'riscv-pk'
         self['opensbi-dir'] = self['board-dir'] / 'firmware' / 'opensbi'
         self['linux-dir'] = self['board-dir'] / 'linux'
@@ -351,17 +368,15 @@ class marshalCtx(collections.abc.MutableMapping):
             self['doitOpts']['dep_file'] = str(self['gen-dir'] / 'marshaldb')
 
         self['distro-mods'] = {}
-        for dPath in (self['board-dir'] / 'distros').glob("*"):
+        for dPath in sorted((self['board-dir'] / 'distros').glob("*")):
             m = self.importDistro(dPath)
             self['distro-mods'][m.__name__] = m
 
         if self['jlevel'] is None:
-            self['jlevel'] = psutil.cpu_count()
-            if self['jlevel'] is None:
-                # logging has not be initialized by this point, have to settle
-                # for print
-                print("WARNING: unable to determine CPU count, defaulting jlevel to 1. You may explicitly set the jlevel in your marshal-config.yaml.")
-                self['jlevel'] = 1
+            self['jlevel'] = _nCpus
+
+        # Precompute the make flag once rather than at every build invocation
+        self['jlevel-arg'] = '-j' + str(self['jlevel'])
 
     def setRunName(self, configPath, operation):
         """Helper function for formatting a  unique run name. You are free to
@@ -378,7 +393,7 @@ class marshalCtx(collections.abc.MutableMapping):
             configName = ''
 
         timeline = time.strftime("%Y-%m-%d--%H-%M-%S", time.gmtime())
-        randname = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+        randname = secrets.token_hex(8)
 
         runName = f"{configName}-{operation}-{timeline}-{randname}"
 
@@ -424,8 +439,7 @@ def initialize():
 
     # Setup disk initramfs dirs
     for d in initramfs_disk_dirs:
-        if not (ctx['initramfs-dir'] / 'disk' / d).exists():
-            (ctx['initramfs-dir'] / 'disk' / d).mkdir(parents=True)
+        (ctx['initramfs-dir'] / 'disk' / d).mkdir(parents=True, exist_ok=True)
 
 
 def getCtx():
@@ -510,21 +524,33 @@ def run(*args, level=logging.DEBUG, check=True, **kwargs):
         level - The logging level to use
         check - Throw an error on non-zero return status"""
 
-    log = logging.getLogger()
-
     if isinstance(args[0], str):
         prettyCmd = args[0]
     else:
         prettyCmd = ' '.join([str(a) for a in args[0]])
 
+    # Lazy %-formatting: the message is only built if 'level' is enabled
     if 'cwd' in kwargs:
-        log.log(level, 'Running: "' + prettyCmd + '" in ' + str(kwargs['cwd']))
+        log.log(level, 'Running: "%s" in %s', prettyCmd, kwargs['cwd'])
     else:
-        log.log(level, 'Running: "' + prettyCmd + '" in ' + os.getcwd())
+        log.log(level, 'Running: "%s" in %s', prettyCmd, _cwd)
 
-    p = sp.Popen(*args, universal_newlines=True, stderr=sp.STDOUT, stdout=sp.PIPE, **kwargs)
-    for line in iter(p.stdout.readline, ''):
-        log.log(level, line.strip())
+    p = sp.Popen(*args, stderr=sp.STDOUT, stdout=sp.PIPE, **kwargs)
+
+    # Read the pipe in large chunks straight from the fd and split lines
+    # ourselves; much cheaper than per-line reads on chatty subcommands
+    fd = p.stdout.fileno()
+    buf = b''
+    while True:
+        chunk = os.read(fd, 1 << 16)
+        if not chunk:
+            break
+        lines = (buf + chunk).split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            log.log(level, line.decode('utf-8', errors='replace').strip())
+    if buf:
+        log.log(level, buf.decode('utf-8', errors='replace').strip())
     p.wait()
 
     if check and p.returncode != 0:
@@ -545,35 +571,41 @@ def run_with_retries(command, level=logging.DEBUG, num_attempts=3, polling_inter
         if run(command, level, check=check_on_last_attempt).returncode == 0:
             break
 
-        log = logging.getLogger()
         log.log(level, "Retrying last command...")
         time.sleep(polling_interval_s)
         attempt_count += 1
 
 
 def genRunScript(command):
-    with open(getOpt('command-script'), 'w') as s:
-        s.write("#!/bin/sh\n")
-        s.write(command + "\n")
-        s.write("sync; poweroff -f\n")
+    getOpt('command-script').write_text(
+            "#!/bin/sh\n" +
+            command + "\n" +
+            "sync; poweroff -f\n")
 
     return getOpt('command-script')
 
 
 def waitpid(pid):
     """This is like os.waitpid, but it works for non-child processes"""
-    done = False
-    while not done:
-        try:
-            os.kill(pid, 0)
-        except OSError as err:
-            if err.errno == errno.ESRCH:
-                done = True
-                break
-        time.sleep(0.25)
+    try:
+        # psutil blocks on a pidfd where available and handles the
+        # portability fallbacks for us
+        psutil.Process(pid).wait()
+    except psutil.NoSuchProcess:
+        # Already exited
+        pass
+
 
+def _havePasswordlessSudo():
+    """Detect passwordless sudo. This runs at import time on every marshal
+    invocation, so spawn the probe directly rather than through subprocess."""
+    with open(os.devnull, 'wb') as devNull:
+        pid = os.posix_spawn('/usr/bin/sudo', ['/usr/bin/sudo', '-ln', 'true'], dict(os.environ),
+                             file_actions=[(os.POSIX_SPAWN_DUP2, devNull.fileno(), 1)])
+    return os.waitpid(pid, 0)[1] == 0
 
-if sp.run(['/usr/bin/sudo', '-ln', 'true'], stdout=sp.DEVNULL).returncode == 0:
+
+if _havePasswordlessSudo():
     # User has passwordless sudo available, use the mount command (much faster)
     sudoCmd = ["/usr/bin/sudo"]
 
@@ -605,13 +637,66 @@ else:
         waitpid(mntPid)
 
 
+def _packCpio(name, ino=0, mode=0, mtime=0, filesize=0, rdev=0):
+    """Format a single newc-format cpio header (including the padded name)."""
+    nameBytes = os.fsencode(name) + b'\x00'
+    fields = [ino, mode, 0, 0, 1, mtime, filesize, 0, 0,
+              os.major(rdev), os.minor(rdev), len(nameBytes), 0]
+    hdr = b'070701' + b''.join(b'%08X' % f for f in fields) + nameBytes
+    return hdr + b'\x00' * (-len(hdr) % 4)
+
+
+def _writeCpio(src, dst):
+    """Archive the directory 'src' into the newc-format cpio file 'dst'.
+
+    In-process equivalent of running 'find -print0 | cpio --owner root:root
+    --null -o --format=newc' from within src: paths are archived relative to
+    src and ownership is forced to root:root."""
+
+    with open(dst, 'wb') as out:
+        ino = 0
+
+        def emit(relName, path):
+            nonlocal ino
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    data = f.read()
+            elif stat.S_ISLNK(st.st_mode):
+                data = os.fsencode(os.readlink(path))
+            else:
+                data = b''
+            out.write(_packCpio(relName, ino=ino, mode=st.st_mode,
+                                mtime=int(st.st_mtime), filesize=len(data),
+                                rdev=st.st_rdev))
+            out.write(data)
+            out.write(b'\x00' * (-len(data) % 4))
+            ino += 1
+
+        emit('.', src)
+        for root, dirs, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            for name in sorted(dirs) + sorted(files):
+                relName = './' + os.path.normpath(os.path.join(rel, name))
+                emit(relName, os.path.join(root, name))
+
+        out.write(_packCpio('TRAILER!!!'))
+
+
 def toCpio(src, dst):
-    log = logging.getLogger()
     log.debug("Creating Cpio archive from " + str(src))
-    with open(dst, 'wb') as outCpio:
-        p = sp.run(sudoCmd + ["sh", "-c", "find -print0 | cpio --owner root:root --null -ov --format=newc"],
-                   stderr=sp.PIPE, stdout=outCpio, cwd=src)
-        log.debug(p.stderr.decode('utf-8'))
+    if sudoCmd:
+        # Need root to read files out of a sudo-mounted image. The two
+        # processes are connected directly (no intermediate shell).
+        with open(dst, 'wb') as outCpio:
+            find = sp.Popen(sudoCmd + ['find', '-print0'], stdout=sp.PIPE, cwd=src)
+            cpio = sp.Popen(sudoCmd + ['cpio', '--owner', 'root:root', '--null', '-ov', '--format=newc'],
+                            stdin=find.stdout, stdout=outCpio, stderr=sp.PIPE, cwd=src)
+            find.stdout.close()  # so cpio sees EOF if find dies early
+            log.debug(cpio.communicate()[1].decode('utf-8'))
+            find.wait()
+    else:
+        _writeCpio(src, dst)
 
 
 def resizeFS(img, newSize=0):
@@ -621,7 +706,6 @@ def resizeFS(img, newSize=0):
     newSize: desired size (in bytes). If 0, shrink the image to its minimum
       size + rootfs-margin
     """
-    log = logging.getLogger()
     chkfsCmd = ['e2fsck', '-f', '-p', str(img)]
     ret = run(chkfsCmd, check=False).returncode
     if ret >= 4:
@@ -646,6 +730,42 @@ def resizeFS(img, newSize=0):
     return
 
 
+def _replacingCopy(src, dst, *, follow_symlinks=True):
+    """shutil.copy2, but replace an existing destination the way cp does
+    (os.symlink refuses to overwrite an existing path)."""
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+
+
+def _hostCopy(src, dst):
+    """In-process equivalent of 'cp -a src dst': preserves metadata and
+    symlinks, merges directories into an existing destination, and replaces
+    existing files."""
+    src = pathlib.Path(src)
+    dst = pathlib.Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+
+    if src.is_dir() and not src.is_symlink():
+        # copytree recreates symlinks with os.symlink directly (not through
+        # copy_function), so existing destinations must be cleared up front
+        # to match cp's replace semantics
+        for root, dirs, files in os.walk(src):
+            for name in dirs + files:
+                p = pathlib.Path(root) / name
+                if p.is_symlink():
+                    target = dst / p.relative_to(src)
+                    if target.is_symlink() or target.exists():
+                        os.unlink(target)
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True,
+                        copy_function=_replacingCopy)
+    else:
+        _replacingCopy(src, dst, follow_symlinks=False)
+
+
 def copyImgFiles(img, files, direction):
     """Copies a list of type FileSpec ('files') to/from the destination image (img).
 
@@ -657,22 +777,34 @@ def copyImgFiles(img, files, direction):
         for f in files:
             if direction == 'in':
                 dst = str(getOpt('mnt-dir') / f.dst.relative_to('/'))
-                run(sudoCmd + ['cp', '-a', str(f.src), dst])
+                if sudoCmd:
+                    # The image is mounted as root; only root can write to it
+                    run(sudoCmd + ['cp', '-a', str(f.src), dst])
+                else:
+                    _hostCopy(f.src, dst)
             elif direction == 'out':
                 src = str(getOpt('mnt-dir') / f.src.relative_to('/'))
-                run(sudoCmd + ['cp', '-a', src, str(f.dst)])
+                if sudoCmd:
+                    # Files in the image may only be readable by root
+                    run(sudoCmd + ['cp', '-a', src, str(f.dst)])
+                else:
+                    # shutil copies with sendfile/copy_file_range on Linux
+                    _hostCopy(src, f.dst)
             else:
                 raise ValueError("direction option must be either 'in' or 'out'")
 
 
+def overlaySpecs(overlay):
+    """Return the list of FileSpecs that applies the overlay directory
+    "overlay" to the root of an image. Useful for batching an overlay with
+    other file copies in a single copyImgFiles() call (one mount)."""
+    return [FileSpec(src=f, dst=pathlib.Path('/')) for f in overlay.glob('*')]
+
+
 def applyOverlay(img, overlay):
     """Apply the overlay directory "overlay" to the filesystem image "img"
        Note that all paths must be absolute"""
-    flist = []
-    for f in overlay.glob('*'):
-        flist.append(FileSpec(src=f, dst=pathlib.Path('/')))
-
-    copyImgFiles(img, flist, 'in')
+    copyImgFiles(img, overlaySpecs(overlay), 'in')
 
 
 _toolVersions = None
@@ -733,8 +865,6 @@ def checkGitStatus(submodule):
     has changed since the last time it ran. The 'sha' or 'rebuild' fields will
     change if the repo has changed (or we can't tell if it's changed)."""
 
-    log = logging.getLogger()
-
     if submodule is None:
         return {
                 'sha': "",